@@ -11,122 +11,547 @@ Features:
 Instructions:
 - Copy this file `medicine_reminder_streamlit.py` to your GitHub repo
 - Create `requirements.txt`:
-  streamlit
+  streamlit>=1.37
   APScheduler
   gTTS
   boto3
   openai
   python-dotenv
+  orjson
 - Deploy on Streamlit Cloud, set secrets for AWS Polly and OpenAI if available
 - App URL will be generated automatically
 """
 
 import streamlit as st
 from datetime import datetime, date, timedelta
-import json, os, threading, time as time_mod
+import gzip, hashlib, io, json, logging, os, queue, re, sqlite3, threading, time
+from collections import OrderedDict
 from uuid import uuid4
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from gtts import gTTS
-try: import boto3
+try:
+    import boto3, botocore.exceptions
+    from botocore.config import Config as BotoConfig
 except: boto3 = None
 try: import openai
 except: openai = None
+try: import fcntl
+except: fcntl = None
+try: import orjson
+except: orjson = None
 
-DATA_FILE = "med_data.json"
+DATA_FILE = "med_data.json"  # legacy store, imported into DB_FILE on first run
+DB_FILE = "med_data.db"
+SCHEDULER_LOCK_FILE = "scheduler.lock"
+# A reminder up to 10 minutes late still fires (once), instead of being dropped or run twice
+JOB_DEFAULTS = {'misfire_grace_time': 600, 'coalesce': True, 'max_instances': 1}
+HISTORY_ARCHIVE_DIR = "history_archive"
+HISTORY_LIMIT = 500  # rows kept in the live history table; older ones are archived weekly
 AUDIO_DIR = "reminder_audio"
+TTS_WORKERS = 4  # tts-worker threads; reminders that fire together synthesize in parallel over one boto3 connection pool
 os.makedirs(AUDIO_DIR, exist_ok=True)
+log = logging.getLogger(__name__)
 
 # ----------------- Utilities -----------------
 
-def load_data():
-    if not os.path.exists(DATA_FILE): return {"medicines": [], "history": []}
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+def json_dumps(obj):
+    # Compact, key-sorted JSON bytes; uses orjson (native) when installed
+    if orjson: return orjson.dumps(obj, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=str, sort_keys=True, separators=(',', ':')).encode()
 
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, default=str)
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
 
-def synthesize_tts(text, filename):
+@st.cache_resource
+def db_lock():
+    # Cached rather than a module global: every Streamlit rerun re-executes this file,
+    # which would hand threads started on different reruns different locks
+    return threading.Lock()
+
+@st.cache_resource
+def get_db():
+    # Shared by Streamlit reruns and scheduler threads; writes go through db_lock()
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS medicines (
+            id TEXT PRIMARY KEY, name TEXT, dose TEXT, times TEXT, start_date TEXT, end_date TEXT, audio_path TEXT, audio_url TEXT)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS history (
+            id TEXT PRIMARY KEY, med_id TEXT, med_name TEXT, ts TEXT, message TEXT, audio TEXT, error TEXT, task_id TEXT, audio_url TEXT, pending INTEGER DEFAULT 0)""")
+        _ensure_column(conn, "medicines", "audio_path")
+        _ensure_column(conn, "medicines", "audio_url")
+        _ensure_column(conn, "history", "task_id")
+        _ensure_column(conn, "history", "audio_url")
+        _ensure_column(conn, "history", "pending", "INTEGER DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_ts ON history (ts DESC)")
+    _import_json_data(conn)
+    return conn
+
+def _ensure_column(conn, table, column, decl="TEXT"):
+    # Upgrade databases created before the column existed
+    if column not in {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _import_json_data(conn):
+    # One-time migration from the old med_data.json store; user_version records that it ran
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= 1: return
+    # Databases that already hold medicines were migrated before user_version was recorded
+    if os.path.exists(DATA_FILE) and not conn.execute("SELECT 1 FROM medicines LIMIT 1").fetchone():
+        with open(DATA_FILE, "rb") as f:
+            data = json_loads(f.read())
+        with conn:
+            for med in data.get("medicines", []): _insert_medicine(conn, med)
+            for entry in data.get("history", []):
+                _insert_history(conn, dict(entry, ts=entry.get('time')))
+    conn.execute("PRAGMA user_version = 1")
+    if os.path.exists(DATA_FILE): os.replace(DATA_FILE, DATA_FILE + ".imported")
+
+def _insert_medicine(conn, med):
+    conn.execute("INSERT OR REPLACE INTO medicines (id, name, dose, times, start_date, end_date, audio_path, audio_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                 (med['id'], med['name'], med.get('dose'), json_dumps(med.get('times', [])).decode(), med.get('start_date'), med.get('end_date'), med.get('audio_path'), med.get('audio_url')))
+
+def _insert_history(conn, entry):
+    conn.execute("INSERT OR REPLACE INTO history (id, med_id, med_name, ts, message, audio, error, task_id, audio_url, pending) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (entry['id'], entry.get('med_id'), entry.get('med_name'), entry.get('ts'), entry.get('message'), entry.get('audio'), entry.get('error'), entry.get('task_id'), entry.get('audio_url'), int(entry.get('pending', False))))
+
+TIME_RE = re.compile(r'([01]\d|2[0-3]):([0-5]\d)')
+
+def _parse_time_lenient(t):
+    # Stored rows may predate strict validation, which accepted anything int(h):int(m) like "9:5"
+    try: hour, minute = map(int, t.split(':'))
+    except ValueError: return None
+    if 0 <= hour < 24 and 0 <= minute < 60: return hour, minute
+
+def parse_times(values, strict=True):
+    # "HH:MM" strings -> ([{'hhmm', 'h', 'm'}, ...], [invalid strings]); already-parsed dicts pass through
+    parsed, invalid = [], []
+    for t in values:
+        if isinstance(t, dict): parsed.append(t); continue
+        match = TIME_RE.fullmatch(t.strip())
+        if match: hm = int(match.group(1)), int(match.group(2))
+        else: hm = None if strict else _parse_time_lenient(t.strip())
+        if hm: parsed.append({'hhmm': f"{hm[0]:02d}:{hm[1]:02d}", 'h': hm[0], 'm': hm[1]})
+        else: invalid.append(t)
+    return parsed, invalid
+
+@st.cache_data(ttl=5, show_spinner=False)
+def list_medicines():
+    # Read once per rerun batch; add/delete invalidate
+    rows = get_db().execute("SELECT * FROM medicines ORDER BY rowid").fetchall()
+    # Rows saved before times were pre-parsed hold plain "HH:MM" strings
+    medicines = []
+    for row in rows:
+        times, invalid_times = parse_times(json_loads(row['times'] or '[]'), strict=False)
+        medicines.append(dict(row, times=times, invalid_times=invalid_times))
+    return medicines
+
+def add_medicine(med):
+    with db_lock(), get_db() as conn: _insert_medicine(conn, med)
+    list_medicines.clear()
+
+def delete_medicine(med_id):
+    with db_lock(), get_db() as conn: conn.execute("DELETE FROM medicines WHERE id = ?", (med_id,))
+    list_medicines.clear()
+
+def append_history(entry):
+    with db_lock(), get_db() as conn: _insert_history(conn, entry)
+
+def update_history(entry_id, **fields):
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    with db_lock(), get_db() as conn: conn.execute(f"UPDATE history SET {cols} WHERE id = ?", (*fields.values(), entry_id))
+
+def compact_history(keep=HISTORY_LIMIT):
+    # Move all but the newest `keep` rows into gzip'd monthly archives (history-YYYY-MM.json.gz)
+    old = get_db().execute("SELECT * FROM history ORDER BY ts DESC LIMIT -1 OFFSET ?", (keep,)).fetchall()
+    if not old: return
+    by_month = {}
+    for row in old: by_month.setdefault((row['ts'] or '')[:7] or 'unknown', []).append(dict(row))
+    os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+    for month, rows in by_month.items():
+        # Appending adds a gzip member; readers see one JSON object per line
+        with gzip.open(os.path.join(HISTORY_ARCHIVE_DIR, f"history-{month}.json.gz"), "ab") as f:
+            f.write(b"".join(json_dumps(row) + b"\n" for row in rows))
+    with db_lock(), get_db() as conn:
+        conn.executemany("DELETE FROM history WHERE id = ?", [(row['id'],) for row in old])
+
+def recent_history(n=10):
+    rows = get_db().execute("SELECT med_name, ts, message, audio, error, task_id, audio_url, pending FROM history ORDER BY ts DESC LIMIT ?", (n,)).fetchall()
+    return [dict(row) for row in rows]
+
+AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
+TTS_VOICE = 'Joanna'  # Change to your preferred Polly voice
+# With a bucket set, scheduled reminders use async Polly tasks and all mp3s are served from S3
+# (the bucket must allow public reads, or set AUDIO_BASE_URL to a CloudFront distribution)
+AUDIO_S3_BUCKET = os.environ.get("POLLY_S3_BUCKET")
+AUDIO_S3_PREFIX = "reminders/"
+AUDIO_BASE_URL = os.environ.get("AUDIO_BASE_URL") or f"https://{AUDIO_S3_BUCKET}.s3.amazonaws.com"
+
+def polly_enabled():
+    return bool(boto3 and os.environ.get("AWS_ACCESS_KEY_ID") and os.environ.get("AWS_SECRET_ACCESS_KEY"))
+
+# boto3 clients are expensive to build (service model parsing); build once per process.
+# Credentials are picked up from the environment / IAM role.
+def _boto_config():
+    # One connection per tts-worker, plus the poller job and the UI thread
+    return BotoConfig(max_pool_connections=TTS_WORKERS + 2, retries={'max_attempts': 2})
+
+@st.cache_resource
+def get_polly_client(region):
+    return boto3.client('polly', region_name=region, config=_boto_config())
+
+@st.cache_resource
+def get_s3_client(region):
+    return boto3.client('s3', region_name=region, config=_boto_config())
+
+# Reminder texts repeat daily, so mp3 bytes are cached per (text, voice). Polly and gTTS are
+# cached separately so one failed Polly call never pins the fallback voice.
+@st.cache_data(persist="disk", show_spinner=False, max_entries=500)
+def _polly_bytes(text, voice):
+    resp = get_polly_client(AWS_REGION).synthesize_speech(Text=text, OutputFormat='mp3', VoiceId=voice)
+    return resp['AudioStream'].read()
+
+@st.cache_data(persist="disk", show_spinner=False, max_entries=500)
+def _gtts_bytes(text):
+    buf = io.BytesIO()
+    gTTS(text=text, lang='en').write_to_fp(buf)
+    return buf.getvalue()
+
+def _synthesize(text, voice):
+    # Returns (engine, mp3 bytes) so callers can keep fallback audio apart from Polly audio
     # Try Amazon Polly if keys & boto3 available
-    aws_key = os.environ.get("AWS_ACCESS_KEY_ID")
-    aws_secret = os.environ.get("AWS_SECRET_ACCESS_KEY")
-    aws_region = os.environ.get("AWS_REGION", "us-east-1")
-    if aws_key and aws_secret and boto3:
-        try:
-            polly = boto3.client('polly', aws_access_key_id=aws_key, aws_secret_access_key=aws_secret, region_name=aws_region)
-            voice = 'Joanna'  # Change to your preferred Polly voice
-            resp = polly.synthesize_speech(Text=text, OutputFormat='mp3', VoiceId=voice)
-            out_path = os.path.join(AUDIO_DIR, filename)
-            with open(out_path, 'wb') as f:
-                f.write(resp['AudioStream'].read())
-            return out_path
+    if polly_enabled():
+        try: return 'polly', _polly_bytes(text, voice)
         except Exception as e:
             st.warning(f"Polly failed, using gTTS fallback: {e}")
     # gTTS fallback
-    tts = gTTS(text=text, lang='en')
-    out_path = os.path.join(AUDIO_DIR, filename)
-    tts.save(out_path)
+    return 'gtts', _gtts_bytes(text)
+
+def synthesize_tts_bytes(text, voice=TTS_VOICE):
+    return _synthesize(text, voice)[1]
+
+def tts_filename(engine, text, voice=TTS_VOICE):
+    # Named by engine as well as text so gTTS fallback audio is never stored under a Polly name
+    digest = hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+    return f"tts-polly-{voice}-{digest}.mp3" if engine == 'polly' else f"tts-gtts-{digest}.mp3"
+
+def is_fallback_audio(path_or_url):
+    # gTTS audio saved while Polly was failing; worth replacing once Polly works again
+    return bool(path_or_url) and polly_enabled() and os.path.basename(path_or_url).startswith("tts-gtts-")
+
+def synthesize_tts(text, voice=TTS_VOICE):
+    engine, data = _synthesize(text, voice)
+    out_path = os.path.join(AUDIO_DIR, tts_filename(engine, text, voice))
+    # Write under a unique temp name and rename, so a crash or a concurrent writer never leaves a partial mp3 at out_path
+    tmp_path = f"{out_path}.{uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
     return out_path
 
+def existing_audio(filename):
+    # (audio_path, audio_url) of an already published file, or None
+    if s3_audio_enabled():
+        # Local copies are removed after upload, so look for the published object instead
+        key = f"{AUDIO_S3_PREFIX}{filename}"
+        if _s3_object_exists(key): return None, f"{AUDIO_BASE_URL}/{key}"
+    else:
+        out_path = os.path.join(AUDIO_DIR, filename)
+        if os.path.exists(out_path): return out_path, None
+
+def reminder_audio(text, voice=TTS_VOICE):
+    # An mp3 already produced for this text is reused without any TTS call. gTTS files are
+    # only reused while Polly is unavailable, so a transient Polly failure never sticks.
+    found = existing_audio(tts_filename('polly' if polly_enabled() else 'gtts', text, voice))
+    return found or publish_audio(synthesize_tts(text, voice))
+
+def s3_audio_enabled():
+    return bool(AUDIO_S3_BUCKET and polly_enabled())
+
+def _s3_object_exists(key):
+    try: get_s3_client(AWS_REGION).head_object(Bucket=AUDIO_S3_BUCKET, Key=key)
+    except botocore.exceptions.ClientError as e:
+        # Without s3:ListBucket, S3 answers a missing key with 403 rather than 404; treat both as a miss
+        if e.response.get('Error', {}).get('Code') in ('403', '404', 'AccessDenied', 'Forbidden', 'NoSuchKey', 'NotFound'): return False
+        raise
+    return True
+
+def publish_audio(out_path):
+    # Returns (audio_path, audio_url); with S3 enabled the local file is uploaded and removed
+    if not s3_audio_enabled(): return out_path, None
+    key = f"{AUDIO_S3_PREFIX}{os.path.basename(out_path)}"
+    get_s3_client(AWS_REGION).upload_file(out_path, AUDIO_S3_BUCKET, key,
+                                          ExtraArgs={'ContentType': 'audio/mpeg', 'CacheControl': 'public,max-age=31536000'})
+    os.remove(out_path)
+    return None, f"{AUDIO_BASE_URL}/{key}"
+
+def synthesize_tts_async(text, voice=TTS_VOICE):
+    # Returns immediately with a Polly TaskId; poll_tts_tasks() records the S3 URL once done
+    resp = get_polly_client(AWS_REGION).start_speech_synthesis_task(OutputFormat='mp3', OutputS3BucketName=AUDIO_S3_BUCKET,
+                                                            OutputS3KeyPrefix=AUDIO_S3_PREFIX, Text=text, VoiceId=voice)
+    return resp['SynthesisTask']['TaskId']
+
+def _adopt_task_output(task_id, text):
+    # Move a finished task's <TaskId>.mp3 to the text-hash key, so later firings find it through existing_audio()
+    s3, task_key = get_s3_client(AWS_REGION), f"{AUDIO_S3_PREFIX}{task_id}.mp3"
+    if text is None: return f"{AUDIO_BASE_URL}/{task_key}"  # medicine deleted; leave the task output as is
+    key = f"{AUDIO_S3_PREFIX}{tts_filename('polly', text)}"
+    s3.copy_object(Bucket=AUDIO_S3_BUCKET, Key=key, CopySource={'Bucket': AUDIO_S3_BUCKET, 'Key': task_key}, MetadataDirective='REPLACE',
+                   ContentType='audio/mpeg', CacheControl='public,max-age=31536000')
+    s3.delete_object(Bucket=AUDIO_S3_BUCKET, Key=task_key)
+    return f"{AUDIO_BASE_URL}/{key}"
+
+def poll_tts_tasks():
+    pending = get_db().execute("""SELECT history.id, history.task_id, medicines.name, medicines.dose FROM history
+                                  LEFT JOIN medicines ON medicines.id = history.med_id
+                                  WHERE history.task_id IS NOT NULL AND history.audio_url IS NULL AND history.error IS NULL""").fetchall()
+    if not pending: return
+    polly = get_polly_client(AWS_REGION)
+    for row in pending:
+        try:
+            task = polly.get_speech_synthesis_task(TaskId=row['task_id'])['SynthesisTask']
+            if task['TaskStatus'] == 'completed':
+                text = reminder_text(dict(row)) if row['name'] is not None else None
+                update_history(row['id'], audio_url=_adopt_task_output(row['task_id'], text))
+            elif task['TaskStatus'] == 'failed':
+                update_history(row['id'], error=task.get('TaskStatusReason', 'Polly task failed'))
+        except Exception as e: update_history(row['id'], error=str(e))
+
 # ----------------- Scheduler -----------------
-scheduler = None
-scheduler_lock = threading.Lock()
-
-def start_scheduler_if_needed():
-    global scheduler
-    with scheduler_lock:
-        if scheduler is None:
-            scheduler = BackgroundScheduler()
-            scheduler.start()
-
-def clear_jobs():
-    global scheduler
-    with scheduler_lock:
-        if scheduler: scheduler.remove_all_jobs()
-
-def schedule_all_jobs():
-    data = load_data()
-    clear_jobs()
-    start_scheduler_if_needed()
-    for med in data.get("medicines", []):
-        for t in med.get("times", []):
-            hour, minute = map(int, t.split(':'))
-            job_id = f"reminder-{med['id']}-{t}"
-            scheduler.add_job(func=make_reminder_job(med), trigger=CronTrigger(hour=hour, minute=minute), id=job_id, replace_existing=True)
+
+SCHEDULER_STANDBY_RETRY = 60  # seconds between lock attempts while another process owns the scheduler
+
+def _try_scheduler_lock():
+    # Returns the held lock file (kept open for the life of the process), or None if another process owns it
+    if fcntl is None: return True
+    lock_file = open(SCHEDULER_LOCK_FILE, 'w')
+    try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError: lock_file.close(); return None
+    return lock_file
+
+def _start_scheduler(scheduler, state):
+    with state['lock']:
+        if scheduler.running: return True
+        state['lock_file'] = _try_scheduler_lock()
+        if state['lock_file'] is None: return False
+        scheduler.start()
+        _requeue_stale_reminders()
+        scheduler.add_job(func=poll_tts_tasks, trigger='interval', seconds=30, id='tts-poller', replace_existing=True)
+        scheduler.add_job(func=compact_history, trigger='interval', weeks=1, next_run_time=datetime.now(), id='history-compaction', replace_existing=True)
+        # Picks up medicines changed from other processes' UIs; a no-op diff otherwise
+        scheduler.add_job(func=lambda: sync_reminder_jobs(scheduler, list_medicines()), trigger='interval', seconds=60,
+                          next_run_time=datetime.now(), id='medicine-sync', replace_existing=True)
+        return True
+
+def _standby(scheduler, state):
+    # Take over if the owning process exits and releases the lock
+    while not _start_scheduler(scheduler, state): time.sleep(SCHEDULER_STANDBY_RETRY)
+
+@st.cache_resource
+def get_scheduler():
+    # One scheduler per process; Streamlit reruns reuse it
+    scheduler = BackgroundScheduler(job_defaults=JOB_DEFAULTS, daemon=True)
+    state = {'lock': threading.Lock(), 'lock_file': None}
+    # If another process owns the lock, jobs wait in this unstarted scheduler until the standby thread takes over
+    if not _start_scheduler(scheduler, state):
+        threading.Thread(target=_standby, args=(scheduler, state), daemon=True, name="scheduler-standby").start()
+    return scheduler
+
+@st.cache_resource
+def _jobs_lock():
+    # The UI and the medicine-sync job both diff jobs; serialize them
+    return threading.Lock()
+
+def sync_reminder_jobs(scheduler, medicines):
+    # Only add/remove the jobs that changed; untouched reminders keep their next run time
+    desired = {f"reminder-{med['id']}-{t['hhmm']}": (med, t) for med in medicines for t in med.get("times", [])}
+    with _jobs_lock():
+        existing = {job.id for job in scheduler.get_jobs() if job.id.startswith("reminder-")}
+        for job_id in existing - desired.keys():
+            scheduler.remove_job(job_id)
+        for job_id in desired.keys() - existing:
+            med, t = desired[job_id]
+            scheduler.add_job(func=make_reminder_job(med), trigger=CronTrigger(hour=t['h'], minute=t['m']), id=job_id, replace_existing=True, **JOB_DEFAULTS)
+
+def schedule_all_jobs(force=False):
+    medicines = list_medicines()
+    meds_hash = hashlib.sha1(json_dumps(medicines)).hexdigest()
+    if not force and st.session_state.get('scheduled_meds_hash') == meds_hash: return
+    sync_reminder_jobs(get_scheduler(), medicines)
+    st.session_state['scheduled_meds_hash'] = meds_hash
+
+def reminder_text(med):
+    return f"Hello. This is your medicine reminder. It's time to take {med['name']}. {med.get('dose','')}. Take it now and you will feel better."
+
+def new_reminder_entry(med):
+    return {
+        'id': str(uuid4()),
+        'med_id': med['id'],
+        'med_name': med['name'],
+        'ts': datetime.now().isoformat(),
+        'message': f"Reminder: time to take your medicine {med['name']}. Dose: {med.get('dose','')}",
+    }
+
+def tts_worker(reminder_q):
+    # Does the slow TTS work off the scheduler threads so reminder timing never waits on it
+    while True:
+        entry_id, text = reminder_q.get()
+        try:
+            if s3_audio_enabled():
+                # Reuse the published mp3 for this text; only a miss starts an async Polly task
+                found = existing_audio(tts_filename('polly', text))
+                fields = {'audio_url': found[1]} if found else {'task_id': synthesize_tts_async(text)}
+            else:
+                audio, audio_url = reminder_audio(text)
+                fields = {'audio': audio, 'audio_url': audio_url}
+        except Exception as e: fields = {'error': str(e)}
+        # Never let a DB error kill the worker; the row stays pending and is re-queued when a scheduler next starts
+        try: update_history(entry_id, pending=0, **fields)
+        except Exception: log.exception("Could not update history row %s", entry_id)
+        finally: reminder_q.task_done()
+
+@st.cache_resource
+def get_reminder_queue():
+    # One queue + worker pool per process
+    reminder_q = queue.Queue()
+    for i in range(TTS_WORKERS):
+        threading.Thread(target=tts_worker, args=(reminder_q,), daemon=True, name=f"tts-worker-{i}").start()
+    return reminder_q
+
+def _requeue_stale_reminders():
+    # Rows left pending by a process that exited; only the scheduler-lock owner runs this,
+    # so rows another live process is still working on are never picked up twice
+    reminder_q = get_reminder_queue()
+    stale = get_db().execute("""SELECT history.id, medicines.name, medicines.dose FROM history
+                                LEFT JOIN medicines ON medicines.id = history.med_id WHERE history.pending = 1""").fetchall()
+    for row in stale:
+        if row['name'] is None: update_history(row['id'], pending=0, error="Medicine was deleted before audio was generated")
+        else: reminder_q.put((row['id'], reminder_text(dict(row))))
+
+def record_reminder(med):
+    entry = new_reminder_entry(med)
+    # Audio is normally pre-synthesized when the medicine is added; otherwise tts-worker fills it in
+    # Fallback gTTS audio goes back through the worker, which retries Polly
+    if med.get('audio_url') and not is_fallback_audio(med['audio_url']): entry['audio_url'] = med['audio_url']
+    elif med.get('audio_path') and os.path.exists(med['audio_path']) and not is_fallback_audio(med['audio_path']): entry['audio'] = med['audio_path']
+    else: entry['pending'] = True
+    append_history(entry)
+    if entry.get('pending'): get_reminder_queue().put((entry['id'], reminder_text(med)))
 
 def make_reminder_job(med):
     def job_func():
-        now = datetime.now().isoformat()
-        data = load_data()
-        entry = {
-            'id': str(uuid4()),
-            'med_id': med['id'],
-            'med_name': med['name'],
-            'time': now,
-            'message': f"Reminder: time to take your medicine {med['name']}. Dose: {med.get('dose','')}",
-        }
-        text = f"Hello. This is your medicine reminder. It's time to take {med['name']}. {med.get('dose','')}. Take it now and you will feel better."
-        filename = f"reminder-{entry['id']}.mp3"
-        try: entry['audio'] = synthesize_tts(text, filename)
-        except Exception as e: entry['audio'] = None; entry['error'] = str(e)
-        data.setdefault('history', []).append(entry)
-        save_data(data)
+        record_reminder(med)
     return job_func
 
-def scheduler_watchdog():
-    while True:
-        try: schedule_all_jobs()
-        except: pass
-        time_mod.sleep(60)
-_thread = threading.Thread(target=scheduler_watchdog, daemon=True)
-_thread.start()
-
 # ----------------- Streamlit UI -----------------
+# Interactive panels are fragments so a click only reruns its own panel
+
+@st.fragment
+def render_medicine_list():
+    for med in list_medicines():
+        with st.expander(f"{med['name']} — {', '.join(t['hhmm'] for t in med['times'])}"):
+            st.write(f"Dose: {med.get('dose')}")
+            if med['invalid_times']: st.warning(f"Ignored invalid stored time(s): {', '.join(med['invalid_times'])}")
+            st.write(f"Start: {med.get('start_date')} — End: {med.get('end_date')}")
+            if st.button(f"Delete {med['name']}", key=f"del-{med['id']}"):
+                delete_medicine(med['id'])
+                schedule_all_jobs()
+                st.rerun(scope="fragment")
+
+@st.fragment
+def render_history():
+    for entry in recent_history(10):
+        st.write(f"**{entry['med_name']}** — {entry['ts']}")
+        st.write(entry.get('message',''))
+        if entry.get('audio_url'): st.audio(entry['audio_url'], format='audio/mp3')
+        elif entry.get('audio') and os.path.exists(entry['audio']):
+            st.audio(entry['audio'], format='audio/mp3')
+        elif entry.get('error'): st.write("Audio generation error:", entry['error'])
+        elif entry.get('task_id') or entry.get('pending'): st.caption("Audio is being generated…")
+
+CHAT_CACHE_TTL = 3600
+CHAT_CACHE_MAX = 200
+
+@st.cache_resource
+def _chat_cache():
+    # prompt -> (reply, cached_at), shared by all sessions and kept in least-recently-used order.
+    # Mirrors st.cache_data(ttl=CHAT_CACHE_TTL, max_entries=CHAT_CACHE_MAX), which cannot cache a streamed reply.
+    return threading.Lock(), OrderedDict()
+
+def _evict_expired_chat_replies(cache, now):
+    for user_msg in [k for k, (_, cached_at) in cache.items() if now - cached_at >= CHAT_CACHE_TTL]:
+        del cache[user_msg]
+
+def _cached_chat_reply(user_msg):
+    lock, cache = _chat_cache()
+    with lock:
+        _evict_expired_chat_replies(cache, time.time())
+        hit = cache.get(user_msg)
+        if hit:
+            cache.move_to_end(user_msg)
+            return hit[0]
+
+def _store_chat_reply(user_msg, reply):
+    lock, cache = _chat_cache()
+    now = time.time()
+    with lock:
+        _evict_expired_chat_replies(cache, now)
+        cache[user_msg] = (reply, now)
+        cache.move_to_end(user_msg)
+        while len(cache) > CHAT_CACHE_MAX: cache.popitem(last=False)
+
+def stream_chat_reply(user_msg):
+    # Yields the reply as it arrives; repeated prompts (retries, reloads) are answered from cache
+    cached = _cached_chat_reply(user_msg)
+    if cached is not None:
+        yield cached
+        return
+    openai_key = os.environ.get('OPENAI_API_KEY')
+    if openai_key and openai:
+        openai.api_key = openai_key
+        resp = openai.ChatCompletion.create(model="gpt-4o-mini", messages=[
+            {"role":"system","content":"You are a helpful medical reminder assistant. Keep replies concise and friendly."},
+            {"role":"user","content":user_msg}
+        ], max_tokens=200, stream=True)
+        parts = []
+        for chunk in resp:
+            part = chunk['choices'][0]['delta'].get('content', '')
+            parts.append(part)
+            yield part
+        reply = ''.join(parts)
+    else:
+        reply = "Fallback reply: Add medicines to schedule reminders."
+        yield reply
+    # Only complete replies are cached; a failed stream raises before this point
+    _store_chat_reply(user_msg, reply)
+
+@st.fragment
+def render_chat():
+    if 'chat_history' not in st.session_state: st.session_state['chat_history'] = []
+    with st.form("chat_form"):
+        user_msg = st.text_input("Ask something")
+        send = st.form_submit_button("Send")
+
+    for q,a in st.session_state.chat_history[-10:]:
+        st.markdown(f"**You:** {q}")
+        st.markdown(f"**Assistant:** {a}")
+
+    if send and user_msg:
+        st.markdown(f"**You:** {user_msg}")
+        st.markdown("**Assistant:**")
+        try: response_text = st.write_stream(stream_chat_reply(user_msg))
+        except Exception as e:
+            response_text = f"OpenAI chat failed: {e}"
+            st.markdown(response_text)
+        st.session_state.chat_history.append((user_msg, response_text))
+
 st.set_page_config(page_title="Medicine Reminder + Voice", layout='wide')
 st.title("Medicine Reminder App — Voice + Chat")
 
+schedule_all_jobs()  # no-op unless medicines changed since last run
+
 col1, col2 = st.columns([2,1])
 
 with col1:
@@ -140,72 +565,45 @@ with col1:
         end_d = st.date_input("End date", value=date.today() + timedelta(days=30))
         submitted = st.form_submit_button("Add / Update Medicine")
         if submitted:
-            data = load_data()
             med_id = str(uuid4())
-            times = [t.strip() for t in times_input.split(',') if t.strip()]
-            med = {'id': med_id,'name': name,'dose': dose,'times': times,'start_date': str(start_d),'end_date': str(end_d)}
-            data.setdefault('medicines', []).append(med)
-            save_data(data)
-            st.success(f"Saved {name}")
-            schedule_all_jobs()
+            times, invalid_times = parse_times(t for t in times_input.split(',') if t.strip())
+            if invalid_times: st.error(f"Invalid time(s), use 24-hour HH:MM: {', '.join(t.strip() for t in invalid_times)}")
+            else:
+                med = {'id': med_id,'name': name,'dose': dose,'times': times,'start_date': str(start_d),'end_date': str(end_d)}
+                try: med['audio_path'], med['audio_url'] = reminder_audio(reminder_text(med))
+                except Exception as e: st.warning(f"Could not pre-generate reminder audio: {e}")
+                add_medicine(med)
+                st.success(f"Saved {name}")
+                schedule_all_jobs()
 
     st.markdown("---")
     st.subheader("Existing Medicines")
-    data = load_data()
-    for med in data.get('medicines', []):
-        with st.expander(f"{med['name']} — {', '.join(med['times'])}"):
-            st.write(f"Dose: {med.get('dose')}")
-            st.write(f"Start: {med.get('start_date')} — End: {med.get('end_date')}")
-            if st.button(f"Delete {med['name']}", key=f"del-{med['id']}"):
-                data['medicines'] = [m for m in data['medicines'] if m['id'] != med['id']]
-                save_data(data)
-                st.experimental_rerun()
+    render_medicine_list()
 
 with col2:
     st.header("Scheduler Controls")
-    if st.button("Start Scheduler"): start_scheduler_if_needed(); schedule_all_jobs(); st.success("Scheduler started")
+    if st.button("Start Scheduler"):
+        schedule_all_jobs(force=True)
+        if get_scheduler().running: st.success("Scheduler started")
+        else: st.warning("Another process is running the reminders; this one is on standby and takes over if it stops.")
     if st.button("Force Run Next Reminder Now"):
-        data = load_data()
-        if data.get('medicines'):
-            make_reminder_job(data['medicines'][0])()  # trigger one reminder
+        medicines = list_medicines()
+        if medicines:
+            med = medicines[0]
+            record_reminder(med)
+            # Play straight from memory; only the scheduled path persists audio files
+            try: st.audio(synthesize_tts_bytes(reminder_text(med)), format='audio/mp3')
+            except Exception as e: st.write("Audio generation error:", e)
             st.success("Triggered one reminder now")
         else: st.info("No medicines exist to trigger.")
 
     st.markdown("---")
     st.subheader("Recent Reminders / History")
-    history = sorted(data.get('history', []), key=lambda x: x.get('time',''), reverse=True)
-    for entry in history[:10]:
-        st.write(f"**{entry['med_name']}** — {entry['time']}")
-        st.write(entry.get('message',''))
-        if entry.get('audio') and os.path.exists(entry['audio']):
-            with open(entry['audio'], 'rb') as f: st.audio(f.read(), format='audio/mp3')
-        elif entry.get('error'): st.write("Audio generation error:", entry['error'])
+    render_history()
 
 st.markdown("---")
 st.header("Chat Assistant")
-if 'chat_history' not in st.session_state: st.session_state['chat_history'] = []
-with st.form("chat_form"):
-    user_msg = st.text_input("Ask something")
-    send = st.form_submit_button("Send")
-    if send and user_msg:
-        response_text = None
-        openai_key = os.environ.get('OPENAI_API_KEY')
-        if openai_key and openai:
-            try:
-                openai.api_key = openai_key
-                resp = openai.ChatCompletion.create(model="gpt-4o-mini", messages=[
-                    {"role":"system","content":"You are a helpful medical reminder assistant. Keep replies concise and friendly."},
-                    {"role":"user","content":user_msg}
-                ], max_tokens=200)
-                response_text = resp['choices'][0]['message']['content']
-            except Exception as e: response_text = f"OpenAI chat failed: {e}"
-        else:
-            response_text = "Fallback reply: Add medicines to schedule reminders."
-        st.session_state.chat_history.append((user_msg, response_text))
-
-for q,a in st.session_state.chat_history[-10:]:
-    st.markdown(f"**You:** {q}")
-    st.markdown(f"**Assistant:** {a}")
+render_chat()
 
 st.markdown("---")
 st.subheader("Deployment Notes")